@@ -1,55 +1,78 @@
 """Search your Libby libraries for books on your Goodreads want-to-read shelf."""
-import atexit
+import asyncio
 import csv
-import multiprocessing
+import logging
+import random
 import re
-import threading
+import shelve
+import time
 import urllib.parse
+from collections import defaultdict, deque
+from dataclasses import dataclass, fields
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from enum import Enum
-from contextlib import contextmanager
-from multiprocessing.pool import ThreadPool
-from time import sleep
+from functools import partial
+from itertools import starmap
+from operator import attrgetter, itemgetter
 from typing import Dict, List
 
 import click
-import requests
-from bs4 import BeautifulSoup
-from pydantic import BaseModel
+import httpx
+import orjson
+import pandas as pd
+from rich.logging import RichHandler
 from rich.progress import Progress
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
-from webdriver_manager.chrome import ChromeDriverManager
 
-
-MOVE_ON_WHEN_BOOK_FOUND = False
-NUM_THREADS = 16
-
-
-class Driver:
-    def __init__(self):
-        # Normal Browser
-        # self.driver = webdriver.Chrome()
-
-        # Headless Browser
-        options = webdriver.ChromeOptions()
-        options.headless = True
-        self.driver = webdriver.Chrome(
-            options=options
-        )
+try:
+    import uvloop
+except ImportError:  # uvloop isn't available on Windows; fall back to the default event loop.
+    uvloop = None
 
 
-threadLocal = threading.local()
-
-
-def create_driver():
-    the_driver = getattr(threadLocal, 'the_driver', None)
-    if the_driver is None:
-        the_driver = Driver()
-        setattr(threadLocal, 'the_driver', the_driver)
-    return the_driver.driver
+# Search each book's libraries in order, and once it's available at one, skip the rest. Skipped
+# searches still get a row in results.csv, with an Availability of SKIPPED.
+MOVE_ON_WHEN_BOOK_FOUND = False
+# Each library gets at most MAX_REQUESTS_PER_LIB searches in flight, and the libraries together
+# at most MAX_CONCURRENT_REQUESTS (see workers_per_lib). Every catalog is served from the same
+# Overdrive host, but with 8 or fewer libraries the per-library cap is the one that applies: our
+# load on the host is MAX_REQUESTS_PER_LIB times the number of libraries. When Overdrive answers
+# 429/503 anyway, back off exponentially (or for as long as its Retry-After header asks) and retry.
+MAX_CONCURRENT_REQUESTS = 64
+MAX_REQUESTS_PER_LIB = 8
+MAX_RETRIES = 4
+RETRY_STATUS_CODES = {429, 503}
+# If Overdrive asks us to wait longer than this before retrying, give up on the search instead.
+MAX_RETRY_DELAY_SECONDS = 60
+# Each attempt at a search is abandoned after this long. A search that still has no answer once
+# its retries are used up is recorded as an ERROR.
+REQUEST_TIMEOUT_SECONDS = 8
+# Results are streamed to results.csv; flush periodically so a crash keeps what was found so far.
+FLUSH_RESULTS_EVERY = 50
+# Redraw the progress bar every this many results, or after this long, whichever comes first.
+PROGRESS_UPDATE_EVERY = 16
+PROGRESS_UPDATE_INTERVAL_SECONDS = 0.1
+# Search results are cached on disk so re-runs only search for books that are new or stale.
+CACHE_PATH = "libby_cache.db"
+CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# Libby is a single page app that renders its search results from Overdrive's "thunder" API.
+# Querying that API directly gives us the same results as JSON, without needing a browser.
+LIBBY_SEARCH_URL = "https://libbyapp.com/library/{lib_key}/search/query-{query}/page-1"
+OVERDRIVE_SEARCH_URL = (
+    "https://thunder.api.overdrive.com/v2/libraries/{lib_key}/media"
+    "?query={query}&page=1&perPage=24&x-client-id=dewey"
+)
+
+logger = logging.getLogger(__name__)
+
+_TITLE_SPLIT = re.compile(r"[:(]")
+# The handful of fields we read from an Overdrive search response.
+_ITEMS = itemgetter("items")
+_ITEM_FIELDS = itemgetter("availableCopies", "ownedCopies", "type")
+_MEDIA_TYPE_ID = itemgetter("id")
+# SearchResult's fields, in results.csv column order.
+_CSV_ROW = attrgetter("title", "author", "lib_name", "avail", "audiobook", "ebook", "search_url")
 
 
 class AvailabilityType(Enum):
@@ -57,67 +80,127 @@ class AvailabilityType(Enum):
     OWNED = "OWNED"
     DEVOID = "DEVOID"
     ERROR = "ERROR"
+    SKIPPED = "SKIPPED"
 
 
-class SearchRow(BaseModel):
+@dataclass(slots=True, frozen=True)
+class SearchRow:
     lib_name: str
     search_url: str
+    api_url: str
     title: str
     author: str
 
 
-class SearchResult(BaseModel):
+@dataclass(slots=True, frozen=True)
+class SearchResult:
     title: str
     author: str
     lib_name: str
     avail: str
-    audiobook: str
-    ebook: str
+    audiobook: bool
+    ebook: bool
     search_url: str
 
     def to_csv_row(self):
-        """Return an array of fields, to be used by a csv writer."""
-        return dict(self).values()
+        """Return a tuple of fields, to be used by a csv writer."""
+        return _CSV_ROW(self)
 
 
-def parse_want_to_read_from_goodreads_export() -> List[Dict]:
+def parse_want_to_read_from_goodreads_export() -> pd.DataFrame:
     """Read in csv file formatted like a goodreads export.
     
-    Returns all rows with books on the "to-read" shelf
+    Returns the Title and Author of all rows with books on the "to-read" shelf
     """
-    all_books = []
-    want_to_read = []
-    with open("goodreads_library_export-11-27-2022.csv", "r") as goodreads_export_csv:
-        reader = csv.DictReader(goodreads_export_csv)
-        all_books = list(reader)
-        for row in all_books:
-            if row["Exclusive Shelf"] == "to-read":
-                want_to_read.append(row)
-    return want_to_read
-
-
-def find_book_at_lib(search_row):
-    """Takes a search_row and executes the search."""
-    driver = create_driver()
-
-    driver.get(search_row.search_url)
-    sleep(4)
-    page: BeautifulSoup = BeautifulSoup(driver.page_source, features="html.parser")
-    avail = AvailabilityType.ERROR.value
-    if "No results." in page.text:
-        avail = AvailabilityType.DEVOID.value
-    elif "Borrow" in page.text:
+    goodreads_export = pd.read_csv(
+        "goodreads_library_export-11-27-2022.csv",
+        usecols=["Title", "Author", "Exclusive Shelf"],
+        dtype=str,
+        keep_default_na=False,
+    )
+    want_to_read = goodreads_export[goodreads_export["Exclusive Shelf"].eq("to-read")]
+    return want_to_read[["Title", "Author"]].reset_index(drop=True)
+
+
+def parse_search_results(data: Dict) -> tuple:
+    """Summarize an Overdrive search response as (availability, has audiobook, has ebook).
+
+    Walks the items once, collecting what was seen, then applies the same precedence
+    the Libby page shows: No results -> Borrow -> Place Hold.
+    """
+    available = owned = False
+    media_types = set()
+    for available_copies, owned_copies, media_type in map(_ITEM_FIELDS, _ITEMS(data)):
+        available = available or available_copies > 0
+        owned = owned or owned_copies > 0
+        media_types.add(_MEDIA_TYPE_ID(media_type))
+
+    if available:
         avail = AvailabilityType.AVAILABLE.value
-    elif "Place Hold" in page.text:
+    elif owned:
         avail = AvailabilityType.OWNED.value
+    else:
+        avail = AvailabilityType.DEVOID.value
+    return avail, "audiobook" in media_types, "ebook" in media_types
+
+
+def retry_delay(response: httpx.Response, attempt: int) -> float:
+    """Seconds to wait before retrying a rate limited search.
+
+    Honors the response's Retry-After header (in seconds or as an HTTP date) when it has one,
+    otherwise backs off exponentially with some jitter.
+    """
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            pass
+    return 2 ** attempt + random.random()
+
+
+async def get_with_backoff(client: httpx.AsyncClient, url: str) -> httpx.Response:
+    """GET url, backing off and retrying while Overdrive says it's rate limiting us or overloaded."""
+    # httpx's timeout applies to each phase (connect, read, ...) separately, so a response that
+    # trickles in could take far longer; wait_for bounds the whole request.
+    response = await asyncio.wait_for(client.get(url), REQUEST_TIMEOUT_SECONDS)
+    for attempt in range(MAX_RETRIES):
+        if response.status_code not in RETRY_STATUS_CODES:
+            break
+        delay = retry_delay(response, attempt)
+        if delay > MAX_RETRY_DELAY_SECONDS:
+            break
+        await asyncio.sleep(delay)
+        response = await asyncio.wait_for(client.get(url), REQUEST_TIMEOUT_SECONDS)
+    response.raise_for_status()
+    return response
+
+
+async def find_book_at_lib(client: httpx.AsyncClient, cache: shelve.Shelf, search_row: SearchRow) -> SearchResult:
+    """Takes a search_row and executes the search, unless a fresh result is already cached."""
+    # Key on the Overdrive request itself, so changing its parameters can't reuse stale results.
+    cache_key = search_row.api_url
+    cached = cache.get(cache_key)
+    if cached is not None and time.time() - cached["searched_at"] < CACHE_TTL_SECONDS:
+        avail, audiobook, ebook = cached["avail"], cached["audiobook"], cached["ebook"]
+    else:
+        avail = AvailabilityType.ERROR.value
+        audiobook = False
+        ebook = False
+        try:
+            response = await get_with_backoff(client, search_row.api_url)
+            avail, audiobook, ebook = parse_search_results(orjson.loads(response.content))
+        # KeyError/TypeError: a response that isn't shaped like a search result (missing or null
+        # fields, a list instead of an object, ...) is an ERROR for this search, not for the run.
+        except (httpx.HTTPError, asyncio.TimeoutError, KeyError, TypeError, ValueError) as error:
+            logger.warning("Search for %s at %s failed: %r", search_row.title, search_row.lib_name, error)
+        else:
+            cache[cache_key] = {"searched_at": time.time(), "avail": avail, "audiobook": audiobook, "ebook": ebook}
 
-    audiobook = False
-    ebook = False
-    if "Play Sample" in page.text:
-        audiobook = True
-    if "Read Sample" in page.text:
-        ebook = True
-    
     return SearchResult(
         title=search_row.title,
         author=search_row.author,
@@ -129,6 +212,17 @@ def find_book_at_lib(search_row):
     )
 
 
+def prune_cache(cache: shelve.Shelf) -> None:
+    """Delete cached search results older than CACHE_TTL_SECONDS, so the cache doesn't grow forever."""
+    now = time.time()
+    stale_keys = [
+        key for key, cached in cache.items()
+        if not isinstance(cached, dict) or now - cached.get("searched_at", 0) >= CACHE_TTL_SECONDS
+    ]
+    for key in stale_keys:
+        del cache[key]
+
+
 def simplify_title(title) -> str:
     """Simplify a title by removing anything after the ':' or in '()'
     
@@ -140,65 +234,190 @@ def simplify_title(title) -> str:
         Something Wicked This Way Comes (Green Town, #2) --> Something Wicket This Way Comes
         The First 90 Days: Critical Success Strategies for New Leaders at All Levels --> The First 90 Days
     """
-    return re.split(":|\(", title)[0].strip()
+    return _TITLE_SPLIT.split(title, 1)[0].strip()
+
+
+
+def workers_per_lib(total_libs: int) -> int:
+    """How many search workers each library gets.
+
+    The libraries split MAX_CONCURRENT_REQUESTS between them, up to MAX_REQUESTS_PER_LIB each,
+    but every library gets at least one worker.
+    """
+    if not total_libs:
+        return 0
+    return min(MAX_REQUESTS_PER_LIB, max(1, MAX_CONCURRENT_REQUESTS // total_libs))
+
 
+async def search_libraries(search_rows: List[SearchRow], csvfile, progress: Progress, task_progress) -> None:
+    """Run every search on a fixed pool of workers sharing one client.
 
+    The search_rows are split up by library, and each library gets workers_per_lib() workers,
+    which pull the next search_row off that library's deque until it is empty. This keeps each
+    worker on one library's catalog, and keeps the number of in-flight requests (and coroutines)
+    bounded no matter how long the to-read shelf is.
 
-def main():
+    With MOVE_ON_WHEN_BOOK_FOUND, the same number of workers instead each take a whole book and
+    search its libraries in order, stopping at the first one where it's available; the rest of
+    that book's libraries are written out as SKIPPED. A per-library semaphore still keeps each
+    library to workers_per_lib() searches at a time.
+
+    Results are written to csvfile as they come in, rather than held until the end, in
+    search_rows order: a result that finishes early waits until the ones before it are written.
+    """
+    libs = list(dict.fromkeys(search_row.lib_name for search_row in search_rows))
+    lib_workers = workers_per_lib(len(libs))
+    csvwriter = csv.writer(csvfile)
+    # Results that finished before some earlier search_row's result, keyed by their index.
+    finished_early = {}
+    next_index_to_write = 0
+    requests_finished = 0
+    last_progress_update = time.monotonic()
+
+    def record(index, result):
+        nonlocal next_index_to_write, requests_finished, last_progress_update
+        logger.debug(result)
+        finished_early[index] = result
+        while next_index_to_write in finished_early:
+            csvwriter.writerow(finished_early.pop(next_index_to_write).to_csv_row())
+            next_index_to_write += 1
+        requests_finished += 1
+        if requests_finished % FLUSH_RESULTS_EVERY == 0:
+            csvfile.flush()
+        # Redrawing the progress bar takes Rich's render lock, so don't do it for every result.
+        now = time.monotonic()
+        if (
+            requests_finished % PROGRESS_UPDATE_EVERY == 0
+            or now - last_progress_update > PROGRESS_UPDATE_INTERVAL_SECONDS
+        ):
+            progress.update(task_progress, completed=requests_finished)
+            last_progress_update = now
+
+    async def lib_worker(client, cache, pending):
+        while pending:
+            index, search_row = pending.popleft()
+            record(index, await find_book_at_lib(client, cache, search_row))
+
+    async def book_worker(client, cache, pending, lib_semaphores):
+        while pending:
+            found = False
+            for index, search_row in pending.popleft():
+                if found:
+                    record(index, SearchResult(
+                        title=search_row.title,
+                        author=search_row.author,
+                        lib_name=search_row.lib_name,
+                        avail=AvailabilityType.SKIPPED.value,
+                        audiobook=False,
+                        ebook=False,
+                        search_url=search_row.search_url
+                    ))
+                    continue
+                async with lib_semaphores[search_row.lib_name]:
+                    result = await find_book_at_lib(client, cache, search_row)
+                found = result.avail == AvailabilityType.AVAILABLE.value
+                record(index, result)
+
+    def start_workers(client, cache):
+        if MOVE_ON_WHEN_BOOK_FOUND:
+            # search_rows come book by book, each book's libraries in order.
+            pending_by_book = defaultdict(list)
+            for index, search_row in enumerate(search_rows):
+                pending_by_book[(search_row.title, search_row.author)].append((index, search_row))
+            pending = deque(pending_by_book.values())
+            lib_semaphores = {lib_name: asyncio.Semaphore(lib_workers) for lib_name in libs}
+            return [
+                asyncio.create_task(book_worker(client, cache, pending, lib_semaphores))
+                for _ in range(lib_workers * len(libs))
+            ]
+        pending_by_lib = defaultdict(deque)
+        for index, search_row in enumerate(search_rows):
+            pending_by_lib[search_row.lib_name].append((index, search_row))
+        return [
+            asyncio.create_task(lib_worker(client, cache, pending))
+            for pending in pending_by_lib.values()
+            for _ in range(lib_workers)
+        ]
+
+    # Every search goes to the same Overdrive host. Over HTTP/2 the requests are multiplexed as
+    # streams on a single connection, so we don't pay a TCP+TLS handshake per in-flight request.
+    limits = httpx.Limits(max_connections=MAX_CONCURRENT_REQUESTS, max_keepalive_connections=16)
+    with shelve.open(CACHE_PATH) as cache:
+        prune_cache(cache)
+        async with httpx.AsyncClient(http2=True, limits=limits, timeout=REQUEST_TIMEOUT_SECONDS) as client:
+            workers = start_workers(client, cache)
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                # If a worker fails (or we're interrupted), stop the rest before the client and
+                # cache they're using are closed out from under them.
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+    progress.update(task_progress, completed=requests_finished)
+
+
+@click.command()
+@click.option("--verbose", is_flag=True, help="Log each search result as it comes in.")
+def main(verbose: bool):
     """Search your Libby libraries for books on your Goodreads want-to-read shelf."""
-    # These lib URLs can be discovered by going to https://libbyapp.com/interview/menu#mainMenu
+    # These lib keys can be discovered by going to https://libbyapp.com/interview/menu#mainMenu
     # and clicking on your library. Your browser will make a request like:
     # https://ntc.api.overdrive.com/v1/provider-subscriptions?libraryKey=utahsonlinelibrary-provo&x-client-id=dewey
     # which will then redirect to a page like:
     # https://libbyapp.com/library/beehive
+    # The last part of that URL is the lib key.
     libs = {
-        "hawaii": "https://libbyapp.com/library/hawaii",
-        "utah": "https://libbyapp.com/library/beehive",
-        # "idaho falls": "https://libbyapp.com/library/ifpl",
-        "livermore": "https://libbyapp.com/library/livermore",
+        "hawaii": "hawaii",
+        "utah": "beehive",
+        # "idaho falls": "ifpl",
+        "livermore": "livermore",
     }
 
+    # Configure only our own logger, so --verbose doesn't also turn on httpx's request logging.
+    logger.addHandler(RichHandler(show_time=False, show_path=False))
+    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+
     want_to_read = parse_want_to_read_from_goodreads_export()
-    for book in want_to_read:
-        book["Title"] = simplify_title(book["Title"])
+    want_to_read["Title"] = want_to_read["Title"].map(simplify_title)
 
     total_books = len(want_to_read)
     total_libs = len(libs.keys())
 
     print(f"Number of to-read titles: {total_books}")
     print(f"Number of libraries: {total_libs}")
-    print(f"Using {NUM_THREADS} threads")
-    search_rows = []
-    for book in want_to_read:
-        title = book["Title"]
-        author = book["Author"]
-        query = f"{title} {author}"
-        url_safe_query = urllib.parse.quote(query)
-        for lib_name, lib_url in libs.items():
-            search_url = f"{lib_url}/search/query-{url_safe_query}/page-1"
-            search_row = SearchRow(lib_name=lib_name, search_url=search_url, title=title, author=author)
-            search_rows.append(search_row)
-
-    pool = ThreadPool(processes=NUM_THREADS)
-
-    with Progress() as progress:
+    print(f"Using up to {workers_per_lib(total_libs) * total_libs} concurrent requests")
+    # Fill in the library part of each URL once, splitting it around where the query goes, so the
+    # full URLs can be built for every book and library at once with column-wise concatenation.
+    libs_frame = pd.DataFrame(
+        [
+            (
+                lib_name,
+                *LIBBY_SEARCH_URL.format(lib_key=lib_key, query="{query}").split("{query}"),
+                *OVERDRIVE_SEARCH_URL.format(lib_key=lib_key, query="{query}").split("{query}"),
+            )
+            for lib_name, lib_key in libs.items()
+        ],
+        columns=["lib_name", "search_url_prefix", "search_url_suffix", "api_url_prefix", "api_url_suffix"],
+    )
+    # Encode "/" too, otherwise a title like "AC/DC" would split the Libby search path.
+    want_to_read["query"] = (want_to_read["Title"] + " " + want_to_read["Author"]).map(
+        partial(urllib.parse.quote, safe="")
+    )
+    rows = want_to_read.merge(libs_frame, how="cross")
+    rows["search_url"] = rows["search_url_prefix"] + rows["query"] + rows["search_url_suffix"]
+    rows["api_url"] = rows["api_url_prefix"] + rows["query"] + rows["api_url_suffix"]
+    # simplify_title can collapse different editions of a book into the same search.
+    # Select the columns in SearchRow's field order, so each tuple lines up with its fields.
+    search_row_fields = [field.name for field in fields(SearchRow)]
+    rows = rows.rename(columns={"Title": "title", "Author": "author"})[search_row_fields].drop_duplicates()
+    search_rows = list(starmap(SearchRow, rows.itertuples(index=False, name=None)))
+
+    with open("results.csv", "w") as csvfile, Progress() as progress:
+        csv.writer(csvfile).writerow(["Title", "Author", "Library Name", "Availability", "Audiobook", "Ebook", "Search URL"])
         task_progress = progress.add_task(f"[green]Searching {total_libs} libraries for {total_books} books...", total=len(search_rows))
-        results = []
-        requests_finished = 0
-        for result in pool.imap(find_book_at_lib, search_rows):
-            print(result)
-            results.append(result)
-            requests_finished += 1
-            progress.update(task_progress, completed=requests_finished)
-
-    pool.close()
-    pool.join()
-
-    with open("results.csv", "w") as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerow(["Title", "Author", "Library Name", "Availability", "Audiobook", "Ebook", "Search URL"])
-        for result in results:
-            csvwriter.writerow(result.to_csv_row())
+        run = asyncio.run if uvloop is None else uvloop.run
+        run(search_libraries(search_rows, csvfile, progress, task_progress))
 
 
 if __name__ == "__main__":